@@ -35,9 +35,9 @@ const App = {
         // API endpoint for Gemini (background refinement)
         apiEndpoint: (() => {
             if (window.location.hostname === 'localhost' || window.location.hostname === '127.0.0.1') {
-                return 'http://localhost:8000/analyze';
+                return 'http://localhost:8000/analyze-bin';
             }
-            return '/analyze';
+            return '/analyze-bin';
         })(),
         processingInterval: 100, // ms between YOLO detections (10 FPS)
         geminiInterval: 2000, // ms between Gemini refinements (0.5 FPS)
@@ -383,24 +383,13 @@ const App = {
             
             const startTime = performance.now();
             
-            // Convert to base64
-            const reader = new FileReader();
-            const base64Promise = new Promise((resolve) => {
-                reader.onloadend = () => resolve(reader.result);
-                reader.readAsDataURL(blob);
-            });
-            const base64 = await base64Promise;
-            
-            // Call Gemini API
+            // Call Gemini API (send the frame as raw bytes, no base64)
             const response = await fetch(this.config.apiEndpoint, {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': blob.type || 'image/webp'
                 },
-                body: JSON.stringify({
-                    image: base64.split(',')[1],
-                    content_type: blob.type || 'image/webp'
-                })
+                body: blob
             });
             
             if (!response.ok) {
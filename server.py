@@ -3,27 +3,71 @@ SignVision Gemini Backend - Label Refinement Server
 Provides accurate sign classification for COCO-SSD detections
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, File, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import google.generativeai as genai
 import os
+import asyncio
 import base64
+import hashlib
+import io
 import logging
-from typing import List, Dict
+import atexit
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from contextlib import aclosing, asynccontextmanager, nullcontext
+from typing import AsyncIterator, List, Dict, NamedTuple, Optional, Tuple
+from typing_extensions import TypedDict
+import msgspec
+import numpy as np
+import orjson
 from dotenv import load_dotenv
+from PIL import Image
+from google.api_core import exceptions as google_exceptions
+from google.rpc import error_details_pb2
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+# BLAKE3 hashes large frames several times faster than SHA-256; fall back if not installed
+try:
+    from blake3 import blake3 as _content_hash
+except ImportError:
+    _content_hash = hashlib.sha256
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging. Records are formatted by the QueueHandler and written to stderr
+# by a background listener thread, so requests never block on the write or its lock.
+_log_listener = QueueListener(queue.SimpleQueue(), logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_listener.queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Micro-batcher collecting concurrent frames into multi-image Gemini calls
+    _batcher.start()
+    yield
+    await _batcher.stop()
+
 # Initialize FastAPI
-app = FastAPI(title="SignVision Gemini Refinement API")
+app = FastAPI(
+    title="SignVision Gemini Refinement API",
+    lifespan=lifespan
+)
 
 # Enable CORS for frontend access
 app.add_middleware(
@@ -40,235 +84,756 @@ if not GEMINI_API_KEY:
     logger.error("GEMINI_API_KEY not found in environment")
     logger.error("Make sure .env file exists with: GEMINI_API_KEY=your_key")
 else:
-    genai.configure(api_key=GEMINI_API_KEY)
+    # The SDK already keeps one client per service for the whole process, so every
+    # request shares its gRPC channel. The transport is left at the default: forcing
+    # "grpc_asyncio" would also apply to the sync client used for list_models,
+    # which can't run on an asyncio channel.
+    client_options = {}
+    GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+    if GEMINI_API_ENDPOINT:
+        # e.g. a regional endpoint closer to the deployment
+        client_options["api_endpoint"] = GEMINI_API_ENDPOINT
+    genai.configure(api_key=GEMINI_API_KEY, client_options=client_options or None)
     logger.info("✅ Gemini API configured successfully")
 
+# Gemini model used for refinement. No models.list() at startup: it is a network
+# round-trip on every cold start, so alternatives are only probed if this one 404s.
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-exp")
+FALLBACK_MODELS = ("gemini-2.0-flash", "gemini-1.5-flash")
+_active_model = GEMINI_MODEL
+_fallback_probed = False
+_fallback_lock = asyncio.Lock()
+
+# Bump whenever the prompt changes so cached results from the old prompt are dropped
+PROMPT_VERSION = "3"
+
+# Kept short: latency and cost grow with prompt tokens, and the JSON shape is
+# given by response_schema rather than described here
+PROMPT = """Detect mounted road signs and signals only. Ignore people, vehicles, animals and handheld objects; a person symbol ON a sign is a sign.
+
+Labels:
+- Street name signs: "Street: <text read from the sign>", e.g. "Street: Park Avenue"
+- Pedestrian signs: "No Walk Sign", "Pedestrian Crossing"
+- Pedestrian signals: "Walk Signal - Green", "Don't Walk - Red"
+- Traffic signs: "Stop Sign", "Yield Sign", "Speed Limit <number>", "One Way", "No Entry"
+- Traffic lights: "Traffic Light - Red" / "- Yellow" / "- Green"
+- Warning signs: e.g. "Construction", "Curve Warning", "Merge Warning"
+
+bbox: [x, y, width, height] as percentages 0-100 of the image, x from the left edge, y from the top.
+color: red (danger), yellow (caution), green (safe/street), blue (info) or orange (construction).
+confidence: 0-100.
+Return [] if there are no signs."""
+
+# Shape of each detection Gemini returns, sent as the structured-output schema.
+# The SDK emits no "required" list for it, so fields can still be missing and
+# _to_detections keeps validating them.
+class GeminiDetection(TypedDict):
+    label: str
+    bbox: List[float]  # [x, y, width, height] as percentages 0-100
+    color: str
+    confidence: float  # 0-100
+
+# JSON mode returns bare JSON, so no markdown fences to strip
+GENERATION_CONFIG = genai.GenerationConfig(
+    temperature=0.0,
+    max_output_tokens=512,
+    response_mime_type="application/json",
+    response_schema=list[GeminiDetection],
+)
+
+# Micro-batching: collect up to BATCH_MAX_SIZE frames, waiting at most BATCH_WINDOW_MS
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 8))
+
+# Frames that arrive together are sent as one multi-image call: PROMPT, then these
+# instructions, then each image preceded by an "Image <idx>:" text part
+BATCH_INSTRUCTIONS = """MULTIPLE IMAGES:
+You will receive several images, each preceded by "Image <number>:".
+Analyze each image on its own, using all the rules above.
+Return one entry per image: {"idx": <image number>, "detections": [<detections for that image>]}
+Use an empty detections list for images with no signs."""
+
+class GeminiBatchEntry(TypedDict):
+    idx: int
+    detections: List[GeminiDetection]
+
+class GeminiBatch(TypedDict):
+    batch: List[GeminiBatchEntry]
+
+BATCH_GENERATION_CONFIG = genai.GenerationConfig(
+    temperature=0.0,
+    max_output_tokens=GENERATION_CONFIG.max_output_tokens * BATCH_MAX_SIZE,
+    response_mime_type="application/json",
+    response_schema=GeminiBatch,
+)
+
+# How long after the first queued frame the batcher waits for more
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", 50))
+
+# Cap concurrent Gemini calls to stay under the API rate limit. The cap is per worker
+# process: with WEB_CONCURRENCY workers the total is GEMINI_MAX_CONCURRENCY x workers.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 8))
+_gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
 # Request model
 class AnalyzeRequest(BaseModel):
     image: str
     content_type: str = "image/jpeg"
 
-# Detection response model
-class Detection(BaseModel):
+# Detection response model. msgspec Structs skip per-field validation on
+# construction and encode to JSON in C, far cheaper than Pydantic on the hot path.
+class Detection(msgspec.Struct):
     label: str
     bbox: List[float]  # [x, y, width, height] normalized 0-1
     color: str
     confidence: float
 
-class AnalyzeResponse(BaseModel):
+class AnalyzeResponse(msgspec.Struct):
     detections: List[Detection]
     processing_time_ms: float
 
-@app.get("/")
-async def root():
-    return FileResponse('index.html')
+_json_encoder = msgspec.json.Encoder()
 
-@app.get("/api/status")
-async def api_status():
-    return {"status": "SignVision Gemini Refinement API", "version": "2.0"}
+def _json_response(result: AnalyzeResponse) -> Response:
+    """Encode with msgspec, bypassing FastAPI's Pydantic response pipeline"""
+    return Response(content=_json_encoder.encode(result), media_type="application/json")
 
-@app.post("/analyze", response_model=AnalyzeResponse)
-async def analyze_image(request: AnalyzeRequest):
+# Result cache: content hash of the decoded image -> (expiry, refined detections).
+# Camera streams send many identical frames, so a hit skips the Gemini round-trip.
+# Entries are a handful of small Detection objects, so bounding by count is enough;
+# the short TTL keeps a static camera from reusing a stale answer indefinitely.
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 512))
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", 60))
+_result_cache: "OrderedDict[bytes, Tuple[float, List[Detection]]]" = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+def _cache_key(image_data: bytes, content_type: str) -> bytes:
+    """Hash the raw image bytes together with everything that affects the result"""
+    h = _content_hash(f"{_active_model}|{PROMPT_VERSION}|{content_type}|".encode())
+    h.update(image_data)
+    # 128 bits is plenty for a per-process cache
+    return h.digest()[:16]
+
+# Optional second-level cache for a single fixed video feed: consecutive frames of a
+# static scene differ bit-for-bit but not visually, so the last few results are also
+# matched by perceptual hash. Off by default: the cache is shared by every client and
+# a 9x8 hash can't see sign text, so two different street names can match.
+NEAR_CACHE_SIZE = int(os.getenv("NEAR_CACHE_SIZE", 0))
+NEAR_CACHE_MAX_DISTANCE = int(os.getenv("NEAR_CACHE_MAX_DISTANCE", 4))
+# Only consecutive frames should match, so entries expire much sooner than exact hits
+NEAR_CACHE_TTL_S = float(os.getenv("NEAR_CACHE_TTL_S", 2))
+# (dhash, model|prompt version, expiry, detections), newest last
+_near_cache: "deque[Tuple[int, str, float, List[Detection]]]" = deque(maxlen=NEAR_CACHE_SIZE)
+
+def _cache_get(key: bytes, phash: Optional[int] = None) -> Optional[List[Detection]]:
+    now = time.monotonic()
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry is not None:
+            expires, detections = entry
+            if now < expires:
+                _result_cache.move_to_end(key)
+                return detections
+            del _result_cache[key]
+        
+        if phash is None:
+            return None
+        version = f"{_active_model}|{PROMPT_VERSION}"
+        for near_hash, near_version, expires, detections in reversed(_near_cache):
+            if (
+                near_version == version
+                and now < expires
+                and (phash ^ near_hash).bit_count() <= NEAR_CACHE_MAX_DISTANCE
+            ):
+                return detections
+        return None
+
+def _cache_put(key: bytes, detections: List[Detection], phash: Optional[int] = None) -> None:
+    now = time.monotonic()
+    with _result_cache_lock:
+        if phash is not None and NEAR_CACHE_SIZE > 0:
+            _near_cache.append(
+                (phash, f"{_active_model}|{PROMPT_VERSION}", now + NEAR_CACHE_TTL_S, detections)
+            )
+        if RESULT_CACHE_MAX_ENTRIES <= 0:
+            return
+        _result_cache[key] = (now + RESULT_CACHE_TTL_S, detections)
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_MAX_ENTRIES:
+            _result_cache.popitem(last=False)
+
+# Frames are shrunk before upload: Gemini's cost and latency scale with pixel count
+MAX_IMAGE_EDGE = int(os.getenv("MAX_IMAGE_EDGE", 1024))
+JPEG_QUALITY = 80
+
+# Flat frames (blank, dark, or noise that averages out) all hash to ~0 and would match each other
+DHASH_MIN_CONTRAST = 8
+DHASH_MIN_BITS = 8
+
+def _dhash(img: Image.Image) -> Optional[int]:
     """
-    Analyze image with Gemini for accurate sign/hazard detection
-    Returns refined labels for COCO-SSD detections
+    64-bit difference hash: sign of the horizontal gradient on a 9x8 grayscale thumbnail
+    Returns None for frames with too little structure for the hash to tell them apart
+    """
+    pixels = np.asarray(img.convert("L").resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    if np.ptp(pixels) < DHASH_MIN_CONTRAST:
+        return None
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    phash = int.from_bytes(bits.tobytes(), "big")
+    if not DHASH_MIN_BITS <= phash.bit_count() <= 64 - DHASH_MIN_BITS:
+        return None
+    return phash
+
+def _prepare_image(image_data: bytes, content_type: str) -> Tuple[bytes, str, Optional[int]]:
+    """
+    Downscale to MAX_IMAGE_EDGE on the longest side and re-encode as JPEG
+    Also returns the perceptual hash of the resized frame when the near cache is enabled
     """
-    import time
-    start_time = time.time()
-    
     try:
-        # Decode base64 image
-        image_data = base64.b64decode(request.image)
+        img = Image.open(io.BytesIO(image_data))
+        img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+        img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=False)
+        phash = _dhash(img) if NEAR_CACHE_SIZE > 0 else None
+        return buf.getvalue(), "image/jpeg", phash
+    except Exception as e:
+        # Let Gemini try the original bytes rather than failing the request
+        logger.warning(f"Could not recompress image, sending as-is: {e}")
+        return image_data, content_type, None
+
+def _image_part(image_data: bytes, content_type: str):
+    """Hand the SDK a ready-made Blob over the raw bytes so it doesn't have to
+    inspect and convert a dict on every request"""
+    return genai.protos.Part(
+        inline_data=genai.protos.Blob(mime_type=content_type, data=image_data)
+    )
+
+def _is_number(value) -> bool:
+    # bool is an int subclass, but true/false is not a confidence
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _to_detections(detections_data: list) -> List[Detection]:
+    """Validate Gemini's raw detections and normalize bboxes to 0-1"""
+    candidates = []
+    for det in detections_data:
+        # Validate required fields
+        if not isinstance(det, dict) or "label" not in det or "bbox" not in det:
+            logger.warning(f"Skipping detection missing required fields: {det}")
+            continue
         
-        # Initialize Gemini model
-        model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        # Validate bbox length
+        if not isinstance(det["bbox"], list) or len(det["bbox"]) != 4:
+            logger.warning(f"Skipping detection with invalid bbox length: {det['bbox']}")
+            continue
         
-        # Prepare image for Gemini
-        image_parts = [{
-            "mime_type": request.content_type,
-            "data": image_data
-        }]
+        # Only real numbers: a float64 cast would turn null into NaN and "12" into 12.0
+        if not all(_is_number(v) for v in det["bbox"]):
+            logger.warning(f"Skipping invalid detection {det}: non-numeric bbox")
+            continue
         
-        # Prompt for traffic sign and hazard detection with OCR
-        prompt = """TRAFFIC SIGNS AND ROAD SIGNS ONLY. Ignore everything else.
-
-DO NOT DETECT:
-❌ People, pedestrians, humans
-❌ Vehicles (cars, trucks, bikes)
-❌ Objects (phones, bags, etc.)
-❌ Animals
-
-ONLY DETECT THESE ROAD SIGNS:
-
-1. **Street Name Signs** (Street Signs):
-   - Green street signs with white text (most common) → "Street: [READ THE TEXT]"
-   - Blue street signs with white text → "Street: [READ THE TEXT]"
-   - White street signs with black text → "Street: [READ THE TEXT]"
-   - Example: If you see "MAIN ST" → "Street: Main Street"
-   
-2. **Pedestrian Signs** (physical signs on poles):
-   - White square sign with person + red circle/diagonal line → "No Walk Sign"
-   - Yellow diamond sign with walking person symbol → "Pedestrian Crossing"
-   
-3. **Pedestrian Signals** (traffic light type):
-   - Walk signal (green hand/person) → "Walk Signal - Green"
-   - Don't Walk signal (red hand/person) → "Don't Walk - Red"
-   
-4. **Traffic Control Signs**:
-   - Stop sign (red octagon) → "Stop Sign"
-   - Yield sign → "Yield Sign"
-   - Speed limit signs → "Speed Limit [number]"
-   - One way, no entry, etc.
-   
-5. **Traffic Lights**:
-   - "Traffic Light - Red"
-   - "Traffic Light - Yellow"
-   - "Traffic Light - Green"
-
-6. **Warning Signs**:
-   - Construction signs
-   - Curve warning
-   - Merge warning
-
-STRICT RULES:
-- ONLY detect mounted signs and signals
-- Ignore all people, even if near signs
-- Ignore all vehicles
-- Ignore all handheld objects
-- If you see a person silhouette ON a sign, that's a SIGN not a person
-- **FOR STREET SIGNS: READ AND INCLUDE THE ACTUAL TEXT** - Extract street names using OCR
-- Use format "Street: [exact street name text]" in the label
-- Example: Green sign showing "PARK AVE" → label should be "Street: Park Avenue"
-
-Response format (JSON only):
-[
-  {
-    "label": "Street: Main Street",
-    "bbox": [x, y, width, height],
-    "color": "green",
-    "confidence": 95
-  }
-]
-
-BBOX FORMAT:
-- [x, y, width, height] as percentages (0-100)
-- x: horizontal position from LEFT edge (0 = left, 100 = right)
-- y: vertical position from TOP edge (0 = top, 100 = bottom)
-- width: horizontal size (typically 10-30)
-- height: vertical size (typically 10-30)
-- ALL VALUES MUST BE BETWEEN 0 AND 100!
-
-Example: Sign at 25% from left, 30% from top, 15% wide, 20% tall:
-  "bbox": [25, 30, 15, 20]
-
-Colors: red (danger), yellow (caution), green (safe/street signs), blue (info), orange (construction)
-
-If no SIGNS, return: []"""
+        candidates.append(det)
+    
+    if not candidates:
+        return []
+    
+    # Clamp and normalize every bbox in one vectorized pass
+    bboxes = np.asarray([det["bbox"] for det in candidates], dtype=np.float64)
+    
+    # NaN/inf would pass the clamp below and reach the client as null
+    finite = np.isfinite(bboxes).all(axis=1)
+    if not finite.all():
+        for i in np.flatnonzero(~finite):
+            logger.warning(f"Skipping invalid detection {candidates[i]}: non-finite bbox")
+        candidates = [det for det, keep in zip(candidates, finite) if keep]
+        if not candidates:
+            return []
+        bboxes = bboxes[finite]
+    
+    # Check all values are between 0-100
+    out_of_range = ((bboxes < 0) | (bboxes > 100)).any(axis=1)
+    for i in np.flatnonzero(out_of_range):
+        det = candidates[i]
+        logger.warning(f"⚠️  Invalid bbox (values must be 0-100): {det['bbox']} for {det['label']}, clamping")
+    np.clip(bboxes, 0, 100, out=bboxes)
+    
+    # Normalize bbox from percentage to 0-1
+    bboxes /= 100.0
+    
+    debug = logger.isEnabledFor(logging.DEBUG)
+    detections = []
+    for det, bbox in zip(candidates, bboxes.tolist()):
+        # msgspec.Struct doesn't type-check on construction, so check what the client relies on
+        label = det["label"]
+        color = det.get("color", "yellow")
+        confidence = det.get("confidence", 50)
+        if not isinstance(label, str) or not isinstance(color, str) or not _is_number(confidence):
+            logger.warning(f"Skipping invalid detection {det}: wrong field types")
+            continue
+        detections.append(Detection(
+            label=label,
+            bbox=bbox,
+            color=color,
+            confidence=confidence / 100.0
+        ))
+        if debug:
+            logger.debug("Valid detection: %s at %s", label, bbox)
+    
+    return detections
+
+@lru_cache(maxsize=16)
+def _get_model(model_name: str, batch: bool) -> genai.GenerativeModel:
+    """Build each GenerativeModel once instead of on every request; models are stateless and safe to share"""
+    generation_config = BATCH_GENERATION_CONFIG if batch else GENERATION_CONFIG
+    return genai.GenerativeModel(model_name, generation_config=generation_config)
+
+# Transient Gemini failures (rate limits, overload) are retried instead of dropping the frame
+# Longest wait between attempts, including a server-requested delay: a frame that
+# would have to wait minutes is stale, and it holds up every frame batched with it
+RETRY_MAX_WAIT_S = 4
+_backoff = wait_random_exponential(min=0.2, max=RETRY_MAX_WAIT_S)
+
+def _retry_wait(retry_state) -> float:
+    """Honour the server's RetryInfo delay when present, otherwise back off with jitter"""
+    exc = retry_state.outcome.exception()
+    # Over gRPC the delay comes as a google.rpc.RetryInfo entry in the status details
+    for detail in getattr(exc, "details", None) or ():
+        if isinstance(detail, error_details_pb2.RetryInfo) and detail.HasField("retry_delay"):
+            delay = detail.retry_delay.ToTimedelta().total_seconds()
+            return min(max(delay, 0.0), RETRY_MAX_WAIT_S)
+    return _backoff(retry_state)
+
+@retry(
+    wait=_retry_wait,
+    stop=stop_after_attempt(4),
+    retry=retry_if_exception_type((
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+    )),
+    reraise=True,
+)
+async def _call_gemini(parts: list, batch: bool = False, stream: bool = False):
+    """
+    Send PROMPT followed by the image parts to Gemini without blocking the event loop
+    With stream=True the first chunk has been received when this returns, so rate limits
+    and missing models are retried here; the caller then holds _gemini_semaphore while
+    it reads the rest of the stream.
+    """
+    while True:
+        model_name = _active_model
+        model = _get_model(model_name, batch)
+        contents = [PROMPT, *parts]
+        try:
+            async with _gemini_semaphore if not stream else nullcontext():
+                return await model.generate_content_async(contents, stream=stream)
+        except google_exceptions.NotFound:
+            if await _switch_to_fallback_model(model_name) is None:
+                raise
+
+async def _switch_to_fallback_model(missing: str) -> Optional[str]:
+    """Replace a model the API reports as missing; the probe runs at most once per process"""
+    global _active_model, _fallback_probed
+    # Requests that 404 while the probe is running wait for it, then see its result
+    async with _fallback_lock:
+        if _active_model != missing:
+            # Another request already switched models
+            return _active_model
+        if _fallback_probed:
+            return None
+        _fallback_probed = True
         
-        # Generate content
-        response = model.generate_content([prompt, image_parts[0]])
+        available = await asyncio.to_thread(
+            lambda: {m.name.removeprefix("models/") for m in genai.list_models()}
+        )
+        for name in FALLBACK_MODELS:
+            if name != missing and name in available:
+                logger.warning(f"⚠️  Model {missing} not available, falling back to {name}")
+                _active_model = name
+                return name
         
-        # Parse response
-        try:
-            # Extract JSON from response
-            text = response.text.strip()
-            
-            # Log raw response for debugging
-            logger.info(f"Gemini response (first 200 chars): {text[:200]}")
-            
-            # Remove markdown code blocks if present
-            if text.startswith("```json"):
-                text = text[7:]
-            elif text.startswith("```"):
-                text = text[3:]
-            if text.endswith("```"):
-                text = text[:-3]
-            text = text.strip()
-            
-            # Handle empty or non-JSON responses
-            if not text or text == "[]":
-                logger.info("Gemini returned no detections")
-                return AnalyzeResponse(
-                    detections=[],
-                    processing_time_ms=(time.time() - start_time) * 1000
-                )
-            
-            import json
-            detections_data = json.loads(text)
+        logger.error(f"❌ Model {missing} not available and no fallback found")
+        return None
+
+def _parse_response(response):
+    """Parse Gemini's JSON reply; logs and returns None if it can't be used"""
+    text = ""
+    try:
+        # Extract JSON from response
+        text = response.text.strip()
+        
+        # Log raw response for debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Gemini response (first 200 chars): %.200s", text)
+        
+        # Handle empty responses
+        if not text:
+            return []
+        
+        return orjson.loads(text)
+    except orjson.JSONDecodeError as e:
+        logger.error(f"❌ JSON parse error: {e}")
+        logger.error(f"Response text (full): {text}")
+        return None
+    except Exception as e:
+        logger.error(f"❌ Unexpected error parsing response: {e}")
+        logger.error(f"Response text: {text}")
+        return None
+
+class _BatchItem(NamedTuple):
+    key: bytes  # content hash, shared with the result cache
+    image_data: bytes
+    content_type: str
+    future: asyncio.Future
+
+class _GeminiBatcher:
+    """
+    Coalesces frames that arrive within BATCH_WINDOW_MS into one multi-image
+    Gemini call, amortizing the per-call overhead across the whole burst.
+    Each caller awaits a future resolved with its own raw detections list
+    (None if Gemini's reply for that image couldn't be parsed).
+    """
+    
+    def __init__(self, max_size: int, window_ms: int):
+        self.max_size = max(1, max_size)
+        self.window = window_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        # The event loop only keeps weak references to tasks, so hold in-flight batches here
+        self.inflight: set = set()
+    
+    def start(self):
+        """Start the collector task on the running loop (called from the app lifespan)"""
+        if self.task is None or self.task.done():
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+    
+    async def submit(self, key: bytes, image_data: bytes, content_type: str) -> Optional[list]:
+        # Lazily start in case the server was run without lifespan events
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(_BatchItem(key, image_data, content_type, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(pending) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
             
-            # Validate it's a list
-            if not isinstance(detections_data, list):
-                logger.error(f"Gemini returned non-list: {type(detections_data)}")
-                return AnalyzeResponse(
-                    detections=[],
-                    processing_time_ms=(time.time() - start_time) * 1000
-                )
+            # Only frames with the same content type share a call
+            groups: Dict[str, list] = {}
+            for item in pending:
+                groups.setdefault(item.content_type, []).append(item)
             
-            # Convert to Detection objects
-            detections = []
-            for det in detections_data:
+            # Keep collecting the next batch while these are in flight
+            for batch in groups.values():
+                task = asyncio.create_task(self._dispatch(batch))
+                self.inflight.add(task)
+                task.add_done_callback(self.inflight.discard)
+    
+    async def _dispatch(self, batch: List[_BatchItem]):
+        # Identical frames in one batch are sent once and share the result
+        waiters: Dict[bytes, List[asyncio.Future]] = {}
+        unique: List[_BatchItem] = []
+        for item in batch:
+            if item.key not in waiters:
+                waiters[item.key] = []
+                unique.append(item)
+            waiters[item.key].append(item.future)
+        
+        try:
+            if len(unique) == 1:
+                image_data, content_type = unique[0].image_data, unique[0].content_type
+                response = await _call_gemini([_image_part(image_data, content_type)])
+                data = _parse_response(response)
+                if data is not None and not isinstance(data, list):
+                    logger.error(f"Gemini returned non-list: {type(data)}")
+                    data = None
+                results = [data]
+            else:
+                parts = [BATCH_INSTRUCTIONS]
+                for idx, item in enumerate(unique):
+                    parts += [f"Image {idx}:", _image_part(item.image_data, item.content_type)]
+                response = await _call_gemini(parts, batch=True)
+                results = self._split(_parse_response(response), len(unique))
+        except Exception as e:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+        
+        for item, result in zip(unique, results):
+            for future in waiters[item.key]:
+                if not future.done():
+                    future.set_result(result)
+    
+    @staticmethod
+    def _split(data, size: int) -> List[Optional[list]]:
+        """Map a {"batch": [{"idx", "detections"}]} reply back to per-image lists"""
+        results: List[Optional[list]] = [None] * size
+        entries = data.get("batch") if isinstance(data, dict) else None
+        if not isinstance(entries, list):
+            logger.error(f"Gemini returned malformed batch: {type(data)}")
+            return results
+        for entry in entries:
+            idx = entry.get("idx") if isinstance(entry, dict) else None
+            if isinstance(idx, int) and 0 <= idx < size and isinstance(entry.get("detections"), list):
+                results[idx] = entry["detections"]
+        missing = results.count(None)
+        if missing:
+            logger.warning(f"Gemini batch reply missing {missing} of {size} images")
+        return results
+
+_batcher = _GeminiBatcher(BATCH_MAX_SIZE, BATCH_WINDOW_MS)
+
+async def _stream_gemini(image_data: bytes, content_type: str) -> AsyncIterator[str]:
+    """Yield Gemini's response text chunk by chunk as it is generated"""
+    async with _gemini_semaphore:
+        # Same retries and model fallback as the non-streaming path
+        response = await _call_gemini([_image_part(image_data, content_type)], stream=True)
+        async for chunk in response:
+            try:
+                yield chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. the final finish_reason chunk)
+                continue
+
+class _ArrayElementScanner:
+    """
+    Incrementally splits a streamed top-level JSON array into its elements
+    Only tracks bracket depth and string/escape state; each element is parsed separately
+    """
+    
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.start = None
+        self.in_string = False
+        self.escaped = False
+        self.closed = False
+    
+    def feed(self, text: str) -> List[str]:
+        """Append text and return the source of every element completed by it"""
+        self.buffer += text
+        elements = []
+        while self.pos < len(self.buffer) and not self.closed:
+            ch = self.buffer[self.pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "[{":
+                self.depth += 1
+                if self.depth == 2:
+                    self.start = self.pos
+            elif ch in "]}":
+                self.depth -= 1
+                if self.depth == 1 and self.start is not None:
+                    elements.append(self.buffer[self.start:self.pos + 1])
+                    self.start = None
+                elif self.depth == 0:
+                    self.closed = True
+            self.pos += 1
+        return elements
+
+def _ndjson(detections: List[Detection]) -> bytes:
+    return _json_encoder.encode_lines(detections)
+
+async def _stream_detections(
+    cache_key: bytes, phash: Optional[int], image_data: bytes, content_type: str
+) -> AsyncIterator[bytes]:
+    """
+    Emit each detection as soon as Gemini has finished generating it
+    Errors are raised to the caller; see analyze_image_stream for how they are surfaced
+    """
+    scanner = _ArrayElementScanner()
+    detections: List[Detection] = []
+    async with aclosing(_stream_gemini(image_data, content_type)) as chunks:
+        async for chunk in chunks:
+            for element in scanner.feed(chunk):
                 try:
-                    # Validate required fields
-                    if "label" not in det or "bbox" not in det:
-                        logger.warning(f"Skipping detection missing required fields: {det}")
-                        continue
-                    
-                    # Validate bbox values are in valid range (0-100)
-                    bbox_raw = det["bbox"]
-                    if len(bbox_raw) != 4:
-                        logger.warning(f"Skipping detection with invalid bbox length: {bbox_raw}")
-                        continue
-                    
-                    # Check all values are between 0-100
-                    if not all(0 <= val <= 100 for val in bbox_raw):
-                        logger.warning(f"⚠️  Invalid bbox (values must be 0-100): {bbox_raw} for {det['label']}")
-                        # Clamp values to valid range
-                        bbox_raw = [max(0, min(100, val)) for val in bbox_raw]
-                        logger.info(f"   Clamped to: {bbox_raw}")
-                    
-                    # Normalize bbox from percentage to 0-1
-                    bbox = [bbox_raw[i] / 100.0 for i in range(4)]
-                    
-                    detections.append(Detection(
-                        label=det["label"],
-                        bbox=bbox,
-                        color=det.get("color", "yellow"),
-                        confidence=det.get("confidence", 50) / 100.0
-                    ))
-                    logger.info(f"✅ Valid detection: {det['label']} at {bbox}")
-                except Exception as e:
-                    logger.warning(f"Skipping invalid detection {det}: {e}")
+                    parsed = _to_detections([orjson.loads(element)])
+                except orjson.JSONDecodeError:
+                    logger.warning(f"Skipping malformed detection: {element[:200]}")
                     continue
-            
-            processing_time = (time.time() - start_time) * 1000
-            
-            logger.info(f"✅ Detected {len(detections)} objects in {processing_time:.0f}ms")
-            
-            return AnalyzeResponse(
-                detections=detections,
-                processing_time_ms=processing_time
-            )
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ JSON parse error: {e}")
-            logger.error(f"Response text (full): {response.text}")
-            # Return empty detections on parse error
+                if parsed:
+                    detections += parsed
+                    yield _ndjson(parsed)
+            if scanner.closed:
+                break
+    
+    # Only a complete array is a trustworthy answer for the cache
+    if not scanner.closed:
+        logger.error(f"❌ Gemini stream ended without a complete JSON array: {scanner.buffer[:200]}")
+        return
+    
+    _cache_put(cache_key, detections, phash)
+
+async def _resume_stream(first: bytes, rest: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Send the already-received first line, then the rest of the stream"""
+    async with aclosing(rest):
+        yield first
+        try:
+            async for line in rest:
+                yield line
+        except Exception as e:
+            # The 200 status has already been sent, so all we can do is stop
+            logger.error(f"Streaming analysis error: {str(e)}")
+
+@app.get("/")
+async def root():
+    return FileResponse('index.html')
+
+@app.get("/api/status")
+async def api_status():
+    return {"status": "SignVision Gemini Refinement API", "version": "2.0"}
+
+async def _analyze(image_data: bytes, content_type: str, start_time: int) -> AnalyzeResponse:
+    """
+    Analyze image with Gemini for accurate sign/hazard detection
+    Returns refined labels for COCO-SSD detections
+    """
+    try:
+        # Shrink before hashing so the same frame at different resolutions shares a cache entry.
+        # Decoding and resampling are CPU-bound, so keep them off the event loop.
+        image_data, content_type, phash = await asyncio.to_thread(_prepare_image, image_data, content_type)
+        
+        # Identical (or visually near-identical) frames reuse the previous result instead of calling Gemini
+        cache_key = _cache_key(image_data, content_type)
+        cached = _cache_get(cache_key, phash)
+        if cached is not None:
+            logger.info("⚡ Cache hit: %d detections", len(cached))
             return AnalyzeResponse(
-                detections=[],
-                processing_time_ms=(time.time() - start_time) * 1000
+                detections=cached,
+                processing_time_ms=(time.perf_counter_ns() - start_time) / 1_000_000
             )
-        except Exception as e:
-            logger.error(f"❌ Unexpected error parsing response: {e}")
-            logger.error(f"Response text: {response.text}")
+        
+        # Generate content (batched with any other frames arriving at the same time)
+        detections_data = await _batcher.submit(cache_key, image_data, content_type)
+        
+        # Unusable reply (already logged): return empty detections, but don't cache them
+        if detections_data is None:
             return AnalyzeResponse(
                 detections=[],
-                processing_time_ms=(time.time() - start_time) * 1000
+                processing_time_ms=(time.perf_counter_ns() - start_time) / 1_000_000
             )
+        
+        # Convert to Detection objects
+        detections = _to_detections(detections_data)
+        
+        processing_time = (time.perf_counter_ns() - start_time) / 1_000_000
+        
+        # One summary line per request; per-detection details are DEBUG only
+        logger.info("✅ Detected %d objects in %.0fms", len(detections), processing_time)
+        
+        _cache_put(cache_key, detections, phash)
+        
+        return AnalyzeResponse(
+            detections=detections,
+            processing_time_ms=processing_time
+        )
             
     except Exception as e:
         logger.error(f"Analysis error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/analyze-bin")
+async def analyze_image_bin(request: Request):
+    """
+    Analyze a raw image upload: the request body is the image itself
+    (Content-Type: image/jpeg, image/webp, ...), with no base64 envelope
+    """
+    start_time = time.perf_counter_ns()
+    image_data = await request.body()
+    if not image_data:
+        raise HTTPException(status_code=400, detail="Empty image body")
+    content_type = request.headers.get("content-type", "image/jpeg").split(";")[0].strip()
+    return _json_response(await _analyze(image_data, content_type, start_time))
+
+@app.post("/analyze_raw")
+async def analyze_image_raw(image: UploadFile = File(...)):
+    """
+    Analyze an image uploaded as multipart/form-data (field name "image")
+    """
+    start_time = time.perf_counter_ns()
+    image_data = await image.read()
+    if not image_data:
+        raise HTTPException(status_code=400, detail="Empty image upload")
+    content_type = image.content_type or "image/jpeg"
+    return _json_response(await _analyze(image_data, content_type, start_time))
+
+@app.post("/analyze", deprecated=True)
+async def analyze_image(request: AnalyzeRequest):
+    """
+    Analyze a base64-encoded image sent in a JSON body
+    Deprecated: base64 inflates uploads by a third, use /analyze-bin instead
+    """
+    start_time = time.perf_counter_ns()
+    try:
+        # Decode base64 image off the event loop (several ms for large frames)
+        image_data = await asyncio.to_thread(base64.b64decode, request.image)
+    except Exception as e:
+        logger.error(f"Analysis error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return _json_response(await _analyze(image_data, request.content_type, start_time))
+
+@app.post("/analyze/stream")
+async def analyze_image_stream(request: AnalyzeRequest):
+    """
+    Same as /analyze, but streams detections as NDJSON (one per line)
+    as soon as Gemini has produced them
+    """
+    try:
+        image_data = await asyncio.to_thread(base64.b64decode, request.image)
+        image_data, content_type, phash = await asyncio.to_thread(
+            _prepare_image, image_data, request.content_type
+        )
+    except Exception as e:
+        logger.error(f"Analysis error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    cache_key = _cache_key(image_data, content_type)
+    cached = _cache_get(cache_key, phash)
+    if cached is not None:
+        logger.info("⚡ Cache hit: %d detections", len(cached))
+        return StreamingResponse(iter([_ndjson(cached)]), media_type="application/x-ndjson")
+    
+    # Wait for the first detection before sending headers, so rate limits, missing
+    # models and other Gemini failures are reported as a 500 rather than an empty 200
+    stream = _stream_detections(cache_key, phash, image_data, content_type)
+    try:
+        first = await anext(stream)
+    except StopAsyncIteration:
+        # No signs (or an unusable reply, already logged)
+        return StreamingResponse(iter([]), media_type="application/x-ndjson")
+    except Exception as e:
+        logger.error(f"Streaming analysis error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    return StreamingResponse(_resume_stream(first, stream), media_type="application/x-ndjson")
+
 # Serve static files (must be LAST after all API routes)
 @app.get("/{filename}")
 async def serve_static(filename: str):
@@ -286,5 +851,19 @@ async def serve_static(filename: str):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # The app is I/O-bound, so one worker is the default. Extra workers
+    # (WEB_CONCURRENCY) each get their own cache, batcher and
+    # GEMINI_MAX_CONCURRENCY budget, so the total Gemini concurrency is
+    # GEMINI_MAX_CONCURRENCY x workers.
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    # loop/http are left at uvicorn's "auto": it already picks uvloop and httptools
+    # when uvicorn[standard] installed them, and falls back where they are missing
+    # Several workers need an import string so each process can import the app; a
+    # single worker runs this module's app directly instead of importing it twice
+    uvicorn.run(
+        "server:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=port,
+        workers=workers
+    )
 